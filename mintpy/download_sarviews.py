@@ -14,12 +14,51 @@ from osgeo import gdal
 from pyproj import Transformer
 import argparse
 import sys
+import time
 from typing import Tuple
 import numpy as np
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+# use the SIMD accelerated orjson parser for large event payloads if available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# stream the event payload and filter products on the fly if ijson is available
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SARVIEWS_API = 'https://gm3385dq6j.execute-api.us-west-2.amazonaws.com/events'
+
+# products of each queried event are cached as JSON Lines, one product per line
+SARVIEWS_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                  'mintpy', 'sarviews')
+SARVIEWS_CACHE_TTL = 24 * 3600  # seconds
+
+
+def get_http_adapter(pool_maxsize: int = 16) -> HTTPAdapter:
+    """
+        HTTPS adapter with retries, keeping up to pool_maxsize connections per host alive.
+    """
+    return HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize,
+                       max_retries=Retry(total=3, backoff_factor=0.5))
+
+
+# reuse one connection pool for the API query and all product downloads
+session = requests.Session()
+session.mount('https://', get_http_adapter())
 
 
 def create_parser(iargs=None):
@@ -44,73 +83,170 @@ def create_parser(iargs=None):
     parser.add_argument('-i', '--id', dest='id',
                         help='SARVIEWS Event ID', required=True)
 
+    parser.add_argument('--parallel', dest='num_worker', type=int, default=8,
+                        help='Number of concurrent downloads (default: %(default)s).')
+
+    parser.add_argument('--refresh', dest='refresh', action='store_true',
+                        help='Query the SARVIEWS API even if the event is cached in:\n' + SARVIEWS_CACHE_DIR)
+
     params = parser.parse_args(args=iargs)
+
+    if params.num_worker < 1:
+        parser.error(f'--parallel must be at least 1, got {params.num_worker}')
     return params
 
 
-def get_sarviews_event(id: str):
+def iter_sarviews_event(id: str):
     """
-        Query the SARVIEWS API to return info for a specific event.
+        Query the SARVIEWS API and yield the products of a specific event one by one.
         id - the sarviews event ID: https://sarviews-hazards.alaska.edu/Event/{id}
+        With ijson the response is parsed as it is downloaded, otherwise it is parsed at once.
     """
-    query = f'https://gm3385dq6j.execute-api.us-west-2.amazonaws.com/events/{id}'
+    url = f'{SARVIEWS_API}/{id}'
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()
+        if ijson is not None:
+            response.raw.decode_content = True
+            yield from ijson.items(response.raw, 'products.item', use_float=True)
+        else:
+            yield from json_loads(response.content)['products']
 
-    url = f'{query}'
-    response = requests.get(url)
-    data = json.loads(response.content)
-    return data
 
+def get_sarviews_products(id: str, path: str, frame: str, startDate=None, endDate=None, refresh=False):
+    """
+        Query the SARVIEWS API for an event and return the products passing keep_product, together with
+        the total number of products in the event. Products are filtered as they are yielded by
+        iter_sarviews_event, so unwanted products are never held in memory.
+        All products are cached to disk, so that later runs within SARVIEWS_CACHE_TTL skip the query.
+    """
+    cache_file = os.path.join(SARVIEWS_CACHE_DIR, f'{id}.jsonl')
+
+    products = []
+    num_total = 0
+    if (not refresh and os.path.isfile(cache_file)
+            and time.time() - os.path.getmtime(cache_file) < SARVIEWS_CACHE_TTL):
+        print(f'read products from cache file: {cache_file}')
+        with open(cache_file, 'rb') as f:
+            for line in f:
+                product = json_loads(line)
+                num_total += 1
+                if keep_product(product, path, frame, startDate, endDate):
+                    products.append(product)
+        return products, num_total
+
+    os.makedirs(SARVIEWS_CACHE_DIR, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            for product in iter_sarviews_event(id):
+                f.write(json.dumps(product) + '\n')
+                num_total += 1
+                if keep_product(product, path, frame, startDate, endDate):
+                    products.append(product)
+    except Exception:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    # only expose complete downloads as cache
+    os.replace(tmp_file, cache_file)
+    return products, num_total
+
+
+def download_file(url: str, dest: str):
+    """
+        Stream a file to disk using the shared session.
+        The file is written to dest.part first, so an interrupted download never leaves a truncated dest.
+    """
+    part_file = f'{dest}.part'
+    try:
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(part_file, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=1 << 20)
+    except Exception:
+        if os.path.isfile(part_file):
+            os.remove(part_file)
+        raise
+
+    os.replace(part_file, dest)
+
+
+def keep_product(product: dict, path: str, frame: str, startDate=None, endDate=None) -> bool:
+    """
+        Check if a SARVIEWS product matches the path, frame and date range of interest.
+        The cheap string comparisons are done first, so the acquisition date is only parsed for candidates.
+    """
+    # job type is a top level string, check it before descending into the granules
+    if product['job_type'] != 'INSAR_GAMMA':
+        return False
 
-def main(iargs=None):
+    granule = product['granules'][0]
+    if str(granule['path']) != path or str(granule['frame']) != frame:
+        return False
 
-    params = create_parser(iargs)
-    event_data = get_sarviews_event(params.id)
+    if startDate or endDate:
+        acquisition_date = datetime.datetime.fromisoformat(granule['acquisition_date'])
+        if startDate and acquisition_date <= startDate:
+            return False
+        if endDate and acquisition_date >= endDate:
+            return False
 
-    products = event_data['products']
-    print(products[0])
+    return True
 
-    # paths = set([product['granules'][0]['path'] for product in products])
-    # frames = set([product['granules'][0]['frame'] for product in products])
 
-    print(len(products))
-
-    # Filter by Path
-    products = [product for product in products if str(
-        product['granules'][0]['path']) == str(params.path)]
+def main(iargs=None):
 
-    # Filter by Frame
-    products = [product for product in products if str(
-        product['granules'][0]['frame']) == str(params.frame)]
+    params = create_parser(iargs)
 
-    # Filter by InSAR
-    products = [product for product in products if str(
-        product['job_type']) == 'INSAR_GAMMA']
+    # keep one connection alive per download thread, otherwise urllib3 discards the extra connections
+    session.mount('https://', get_http_adapter(max(params.num_worker, 16)))
 
+    # Filter by path, frame, job type and acquisition date while parsing the event
+    startDate = endDate = None
     if params.start:
         startDate = datetime.datetime.strptime(
             params.start, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
 
-        products = [product for product in products if
-                    datetime.datetime.fromisoformat(product['granules'][0]['acquisition_date']) > startDate]
-
     if params.end:
         endDate = datetime.datetime.strptime(
             params.end, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
 
-        products = [product for product in products if
-                    datetime.datetime.fromisoformat(product['granules'][0]['acquisition_date']) < endDate]
-
+    products, num_total = get_sarviews_products(params.id, str(params.path), str(params.frame),
+                                                startDate, endDate, refresh=params.refresh)
+    print(f'{num_total} products found for event {params.id}')
     print(f'{len(products)} products available after filtering by path frame')
 
+    cwd = os.getcwd()
+    jobs = {}
     for product in products:
         url = product['files']['product_url']
-        print(f'Downloading {url}')
-
-        cwd = os.getcwd()
-        name = os.path.basename(url)
-        dest = os.path.join(cwd, params.output, name)
-
-        urllib.request.urlretrieve(url, dest)
+        jobs[url] = os.path.join(cwd, params.output, os.path.basename(url))
+
+    # downloads are network bound, so threads sharing the session are sufficient
+    failed = []
+    with ThreadPoolExecutor(max_workers=params.num_worker) as pool:
+        futures = {pool.submit(download_file, url, dest): url for url, dest in jobs.items()}
+        completed = as_completed(futures)
+        if tqdm is not None:
+            completed = tqdm(completed, total=len(futures), unit='file')
+
+        for future in completed:
+            url = futures[future]
+            try:
+                future.result()
+                if tqdm is None:
+                    print(f'Downloaded {url}')
+            except Exception as e:
+                print(f'Error: {url} - {e}')
+                failed.append(url)
+
+    if len(failed) > 0:
+        print(f'Failed to download {len(failed)} of {len(jobs)} products:')
+        for url in sorted(failed):
+            print(f'    {url}')
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -6,17 +6,35 @@
 ############################################################
 
 import os
-import glob
-import json
+import fnmatch
 import shutil
-from osgeo import gdal
+import functools
+from osgeo import gdal, osr
 from pyproj import Transformer
 import argparse
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Tuple
 import numpy as np
 
 
+# tiled GeoTIFF, internal overviews are added afterwards by build_overviews()
+TIFF_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE',
+                         'PREDICTOR=3', 'BIGTIFF=IF_SAFER']
+# COPY_SRC_OVERVIEWS is only supported by CreateCopy, i.e. gdal.Translate but not gdal.Warp
+TRANSLATE_CREATION_OPTIONS = TIFF_CREATION_OPTIONS + ['COPY_SRC_OVERVIEWS=YES']
+OVERVIEW_LEVELS = [2, 4, 8, 16]
+
+# file name patterns of the HyP3 products, one directory per interferogram
+HYP3_PATTERNS = {
+    'cor'  : '*_corr.tif',
+    'unw'  : '*_unw_phase.tif',
+    'dem'  : '*_dem.tif',
+    'inc'  : '*_lv_theta.tif',
+    'meta' : '*[!.md].txt',
+}
+
+
 def create_parser(iargs=None):
     parser = argparse.ArgumentParser(description='Subset a stack of HyP3 Interferograms and generate a template MintPy directory structure. On completion, run: smallBaselineApp.py template.txt',
                                      formatter_class=argparse.RawTextHelpFormatter)
@@ -27,14 +45,24 @@ def create_parser(iargs=None):
                         type=float, nargs=2, help='subset range in longitude: W E', required=False)
     parser.add_argument('-w', '--WGS84', default=False, action='store_true',
                         help="Reproject files to a lat-lon coordinate system")
+    parser.add_argument('--parallel', dest='num_worker', type=int, default=os.cpu_count(),
+                        help='Number of worker processes used to clip the stack (default: %(default)s).')
 
     parser.add_argument(
         '-o', '--output', dest='output', help='Path to build directory structure', required=True)
     params = parser.parse_args(args=iargs)
+
+    if params.num_worker < 1:
+        parser.error(f'--parallel must be at least 1, got {params.num_worker}')
     return params
 
 
-def build_template(mintpy_path):
+def build_template(mintpy_path, outputs: dict = None):
+    """
+        Write the MintPy template for the clipped stack.
+        outputs - dict of generated files per HYP3_PATTERNS key. MintPy only loads the first sorted file of
+        each geometry dataset, so if given, that exact path is written instead of a pattern to search for.
+    """
 
     if os.path.exists(mintpy_path):
         try:
@@ -44,7 +72,15 @@ def build_template(mintpy_path):
 
     os.mkdir(mintpy_path)
 
-    directory = os.path.join(mintpy_path, '../hyp3')
+    directory = os.path.abspath(os.path.join(mintpy_path, '../hyp3'))
+
+    dem_file = os.path.join(directory, '*/*dem.tif')
+    inc_file = os.path.join(directory, '*/*lv_theta.tif')
+    if outputs:
+        if outputs.get('dem'):
+            dem_file = sorted(outputs['dem'])[0]
+        if outputs.get('inc'):
+            inc_file = sorted(outputs['inc'])[0]
 
     template = f"""
 mintpy.load.processor        = hyp3
@@ -52,8 +88,8 @@ mintpy.load.processor        = hyp3
 mintpy.load.unwFile          = {os.path.join(directory, '*/*unw_phase.tif')}
 mintpy.load.corFile          = {os.path.join(directory, '*/*corr.tif')}
 # ---------geometry datasets:
-mintpy.load.demFile          = {os.path.join(directory, '*/*dem.tif')}
-mintpy.load.incAngleFile     = {os.path.join(directory, '*/*lv_theta.tif')}
+mintpy.load.demFile          = {dem_file}
+mintpy.load.incAngleFile     = {inc_file}
     """
 
     with open(os.path.join(mintpy_path, 'template.txt'), 'w') as f:
@@ -65,45 +101,55 @@ def get_utm_zone(path: str) -> str:
         Extract the UTM zone from a geotiff given by the path.
     """
 
-    info = gdal.Info(path, options=['-json'])
-    info = json.dumps(info)
-    info = (json.loads(info))['coordinateSystem']['wkt']
-    utm = info.split('ID')[-1].split(',')[1][0:-2]
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(probe(path)[3])
+
+    # fall back to matching the definition against the EPSG database if the WKT carries no authority
+    if srs.GetAuthorityCode('PROJCS') is None:
+        srs.AutoIdentifyEPSG()
+
+    utm = srs.GetAuthorityCode('PROJCS')
+    if utm is None:
+        raise ValueError(f'Could not identify the UTM EPSG code of {path}')
     return utm
 
 
+@functools.lru_cache(maxsize=None)
+def get_transformer(utm: str) -> Transformer:
+    """
+        Build the lat lon to UTM transformer once per zone, as each construction queries the PROJ database.
+    """
+    return Transformer.from_crs(
+        "epsg:4326", f'epsg:{utm}', always_xy=True)
+
+
 def lonLat_to_utm(lon: float, lat: float, utm: str) -> Tuple[float, float]:
     """
         Use pyproj to convert a lat lon pair to an easting northing pair given a utm zone.
+        lon and lat may also be sequences, to transform several points in a single call.
     """
-    transformer = Transformer.from_crs(
-        "epsg:4326", f'epsg:{utm}', always_xy=True)
-    easting, northing = transformer.transform(lon, lat)
+    easting, northing = get_transformer(utm).transform(lon, lat)
     return (easting, northing)
 
 
 def correct_inc(theta_map: str):
-
-    ds = gdal.Open(theta_map)
+    """
+        Convert the HyP3 look vector elevation angle into an incidence angle, updating the geotiff in place.
+    """
+    ds = gdal.Open(theta_map, gdal.GA_Update)
     band = ds.GetRasterBand(1)
-    theta = band.ReadAsArray()
-
-    # Calculation
-    theta = (np.pi/2 - theta)
-
-    # Re-write data
-    driver = gdal.GetDriverByName("GTiff")
-
-    outdata = driver.Create(
-        theta_map, theta.shape[1], theta.shape[0], 1, band.DataType)
-
-    # sets same geotransform as input
-    outdata.SetGeoTransform(ds.GetGeoTransform())
-    outdata.SetProjection(ds.GetProjection())  # sets same projection as input
-    outdata.GetRasterBand(1).WriteArray(theta)
-    outdata.GetRasterBand(1).SetNoDataValue(0)
-    outdata.FlushCache()  # saves to disk!!
-    outdata = None
+    xsize, ysize = band.XSize, band.YSize
+    bx, by = band.GetBlockSize()
+
+    # Calculation, block by block along the native tiling to keep the working set small
+    for yoff in range(0, ysize, by):
+        for xoff in range(0, xsize, bx):
+            theta = band.ReadAsArray(xoff, yoff, min(bx, xsize - xoff), min(by, ysize - yoff))
+            np.subtract(np.pi / 2, theta, out=theta)
+            band.WriteArray(theta, xoff, yoff)
+
+    band.SetNoDataValue(0)
+    band.FlushCache()  # saves to disk!!
     band = None
     ds = None
 
@@ -117,62 +163,141 @@ def move_and_clip(path: str, destination: str, utm: str, ul_utm, lr_utm):
         shutil.copyfile(path, destination)
     elif '.tif' in path:
         options = gdal.TranslateOptions(
-            projWin=[ul_utm[0], ul_utm[1], lr_utm[0], lr_utm[1]], projWinSRS=f'EPSG:{utm}', noData=0, creationOptions=['COMPRESS=DEFLATE'])
+            projWin=[ul_utm[0], ul_utm[1], lr_utm[0], lr_utm[1]], projWinSRS=f'EPSG:{utm}', noData=0, creationOptions=TRANSLATE_CREATION_OPTIONS)
 
         gdal.Translate(destination, path, options=options)
 
 
-def to_WGS84(path: str):
+def build_overviews(path: str):
+    """
+        Build internal overviews for a geotiff, so that viewers and downstream steps can read reduced resolutions.
+    """
     if '.tif' in path:
-        gdal.Warp(path, path, dstSRS='EPSG:4326')
+        ds = gdal.Open(path, gdal.GA_Update)
+        ds.BuildOverviews('AVERAGE', OVERVIEW_LEVELS)
+        ds = None
 
 
-def get_paths(paths: list or str):
+def to_WGS84(path: str, destination: str):
     """
-        Get a list of paths to the desired geotiffs from a list of glob patterns.
+        Reproject a geotiff to lat lon into destination.
     """
-    if type(paths) is str:
-        paths = [paths]
+    if '.tif' in path:
+        gdal.Warp(destination, path, dstSRS='EPSG:4326', creationOptions=TIFF_CREATION_OPTIONS)
 
-    tiff_paths = []
-    for path in paths:
-        tiff_paths += glob.glob(path)
 
-    tiff_paths.sort()
-    return tiff_paths
+def configure_gdal(cachemax: int):
+    """
+        Set the GDAL config options for reading many files: avoid scanning sibling files on every open,
+        and limit the block cache to cachemax MB.
+    """
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+    gdal.SetConfigOption('GDAL_CACHEMAX', str(cachemax))
+    gdal.SetConfigOption('VSI_CACHE', 'TRUE')
 
 
-def get_res(path: str):
+def clip_worker(job):
+    """
+        Clip a single file into the MintPy directory structure, applying the incidence angle correction and
+        reprojection if required. Defined at module scope so that it can be pickled by the process pool.
+    """
+    path, destination, utm, ul_utm, lr_utm, wgs84 = job
+
+    # the outer process pool owns the parallelism
+    gdal.UseExceptions()
+    gdal.SetConfigOption('GDAL_NUM_THREADS', '1')
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+    is_inc = 'lv_theta' in destination
+    if '.tif' not in path or not (is_inc or wgs84):
+        move_and_clip(path, destination, utm, ul_utm, lr_utm)
+
+    else:
+        # chain the clip, correction and reprojection in memory, so only the final product is written to disk
+        clipped = f'/vsimem/{os.path.basename(destination)}'
+        try:
+            move_and_clip(path, clipped, utm, ul_utm, lr_utm)
+
+            if is_inc:
+                correct_inc(clipped)
+
+            if wgs84:
+                to_WGS84(clipped, destination)
+            else:
+                gdal.Translate(destination, clipped, creationOptions=TRANSLATE_CREATION_OPTIONS)
+        finally:
+            # free the in-memory raster even on failure, as the pool process is long lived
+            if gdal.VSIStatL(clipped) is not None:
+                gdal.Unlink(clipped)
+
+    # overviews are built last so they reflect the final pixel values
+    build_overviews(destination)
+
+    return destination
+
+
+def get_paths(tiff_dir: str) -> dict:
+    """
+        Get the paths to the desired HyP3 files, classified by HYP3_PATTERNS key,
+        with a single scan of the interferogram directories in tiff_dir.
+    """
+    paths = {key: [] for key in HYP3_PATTERNS}
+    with os.scandir(tiff_dir) as ifg_dirs:
+        for ifg_dir in ifg_dirs:
+            if ifg_dir.name.startswith('.') or not ifg_dir.is_dir():
+                continue
+
+            with os.scandir(ifg_dir.path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    for key, pattern in HYP3_PATTERNS.items():
+                        if fnmatch.fnmatch(entry.name, pattern):
+                            paths[key].append(entry.path)
+                            break
+
+    for key in paths:
+        paths[key].sort()
+    return paths
+
+
+@functools.lru_cache(maxsize=None)
+def probe(path: str):
+    """
+        Open a geotiff once and return its geotransform, size and projection WKT.
+        Results are cached so each file header is only parsed once.
+    """
     data = gdal.Open(path)
-    geoTransform = data.GetGeoTransform()
+    return data.GetGeoTransform(), data.RasterXSize, data.RasterYSize, data.GetProjection()
+
+
+def get_res(path: str):
+    geoTransform = probe(path)[0]
     return geoTransform[1], geoTransform[5]
 
 
 def get_bounds(path: str):
 
-    data = gdal.Open(path)
-    geoTransform = data.GetGeoTransform()
+    geoTransform, xsize, ysize, _ = probe(path)
     minx = geoTransform[0]
     maxy = geoTransform[3]
-    maxx = minx + geoTransform[1] * data.RasterXSize
-    miny = maxy + geoTransform[5] * data.RasterYSize
+    maxx = minx + geoTransform[1] * xsize
+    miny = maxy + geoTransform[5] * ysize
     return [minx, miny, maxx, maxy]
 
 
-def get_min_bounds(paths):
+def get_min_bounds(paths_unwrapped: list):
 
-    paths_unwrapped = get_paths(paths)
-    bounds = np.zeros((len(paths_unwrapped), 4))
-    for i in range(len(paths_unwrapped)):
-        bounds[i] = get_bounds(paths_unwrapped[i])
+    bounds = np.asarray([get_bounds(path) for path in paths_unwrapped], dtype=np.float64)
 
-    print(bounds)
-    min_bounds = (np.max(bounds.T[0]), np.max(bounds.T[1]), np.min(
-        bounds.T[2]), np.min(bounds.T[3]))
+    # intersection of all extents: largest minimum and smallest maximum per column
+    maxs = bounds.max(axis=0)
+    mins = bounds.min(axis=0)
 
     # Return ul_utm, lr_utm (x, y)
-    ul_utm = [min_bounds[0], min_bounds[3]]
-    lr_utm = [min_bounds[1], min_bounds[2]]
+    ul_utm = [maxs[0], mins[3]]
+    lr_utm = [mins[2], maxs[1]]
     return (ul_utm, lr_utm)
 
 
@@ -182,82 +307,84 @@ def main(iargs=None):
     tiff_dir = parameters.path
     cwd = os.getcwd()
 
-    # Find HyP3 Data
-    paths_cor = f"{tiff_dir}/**/*_corr.tif"
-    paths_unw = f"{tiff_dir}/**/*_unw_phase.tif"
-    paths_dem = f"{tiff_dir}/**/*_dem.tif"
-    paths_inc = f"{tiff_dir}/**/*_lv_theta.tif"
-    paths_meta = f"{tiff_dir}/**/*[!.md].txt"
-
-    paths = [paths_cor, paths_unw, paths_dem, paths_inc, paths_meta]
+    # share the block cache budget among the workers
+    cachemax = max(64, 1024 // parameters.num_worker)
+    configure_gdal(cachemax)
 
+    # Find HyP3 Data
     if os.path.exists(tiff_dir):
-        tiff_paths = get_paths(paths)
+        paths = get_paths(tiff_dir)
+        tiff_paths = sorted(path for key in HYP3_PATTERNS for path in paths[key])
         print(f'Found {len(tiff_paths)} files')
-        if len(tiff_paths) < 1:
-            print(f"{tiff_dir} exists but contains no tifs.")
+        if len(paths['unw']) < 1:
+            print(f"{tiff_dir} exists but contains no unwrapped interferogram tifs.")
             print("You will not be able to proceed until tifs are prepared.")
-            exit
+            sys.exit(1)
     else:
         print(f"\n{tiff_dir} does not exist.")
-        exit
-
-    # Setup MintPy Directory
-    if os.path.exists(parameters.output):
-        print('Output directory already exists, overwriting...')
-    else:
-        os.mkdir(os.path.join(cwd, parameters.output))
-
-    # Create a new folder for each interferogram
-    interferograms = set([os.path.basename(
-        os.path.dirname(path)) for path in tiff_paths])
-
-    hyp3_path = os.path.join(cwd, parameters.output, 'hyp3')
-
-    if not os.path.exists(hyp3_path):
-        os.mkdir(hyp3_path)
-
-    for name in interferograms:
-        new_path = os.path.join(hyp3_path, name)
-        if os.path.exists(new_path):
-            try:
-                shutil.rmtree(new_path)
-            except OSError as e:
-                print("Error: %s - %s." % (e.filename, e.strerror))
-        os.mkdir(new_path)
+        sys.exit(1)
 
     # Parse Bounding Box
-    utm = get_utm_zone(get_paths(paths_unw)[0])
+    utm = get_utm_zone(paths['unw'][0])
 
     if parameters.subset_lat is None or parameters.subset_lon is None:
         print('Generating bounding box based on stack minimum extent')
-        ul_utm, lr_utm = get_min_bounds(paths_unw)
+        ul_utm, lr_utm = get_min_bounds(paths['unw'])
 
     else:
         ul_lat = [parameters.subset_lon[0], parameters.subset_lat[1]]
         lr_lat = [parameters.subset_lon[1], parameters.subset_lat[0]]
-        ul_utm = lonLat_to_utm(ul_lat[0], ul_lat[1], utm)
-        lr_utm = lonLat_to_utm(lr_lat[0], lr_lat[1], utm)
+        eastings, northings = lonLat_to_utm([ul_lat[0], lr_lat[0]], [ul_lat[1], lr_lat[1]], utm)
+        ul_utm = (eastings[0], northings[0])
+        lr_utm = (eastings[1], northings[1])
 
     print(ul_utm, lr_utm)
-    # return
+
+    # Setup MintPy Directory, only once the inputs and bounding box are known to be usable
+    if os.path.exists(parameters.output):
+        print('Output directory already exists, overwriting...')
+    else:
+        os.mkdir(os.path.join(cwd, parameters.output))
+
+    # Start from an empty hyp3 folder, the folder of each interferogram is created by the clip worker
+    hyp3_path = os.path.join(cwd, parameters.output, 'hyp3')
+    shutil.rmtree(hyp3_path, ignore_errors=True)
+    os.makedirs(hyp3_path, exist_ok=True)
+
     # Generate MintPy file structure with clipped Geotiffs
+    jobs = []
     for file in tiff_paths:
         destination = os.path.join(
             cwd, parameters.output, 'hyp3', os.path.basename(os.path.dirname(file)), os.path.basename(file))
-
-        move_and_clip(file, destination, utm, ul_utm,
-                      lr_utm)
-
-        if 'lv_theta' in destination:
-            correct_inc(file)
-
-        if parameters.WGS84:
-            to_WGS84(destination)
+        jobs.append((file, destination, utm, ul_utm, lr_utm, parameters.WGS84))
+
+    # record the generated files of each dataset for the template
+    file_keys = {path: key for key in HYP3_PATTERNS for path in paths[key]}
+    outputs = {key: [] for key in HYP3_PATTERNS}
+
+    print(f'Clipping {len(jobs)} files with {parameters.num_worker} workers')
+    failed = []
+    # config options are not inherited with the spawn / forkserver start methods, so set them in each worker
+    with ProcessPoolExecutor(max_workers=parameters.num_worker,
+                             initializer=configure_gdal, initargs=(cachemax,)) as pool:
+        futures = {pool.submit(clip_worker, job): job[0] for job in jobs}
+        for future in as_completed(futures):
+            try:
+                outputs[file_keys[futures[future]]].append(future.result())
+            except Exception as e:
+                print(f'Error: {futures[future]} - {e}')
+                failed.append(futures[future])
+
+    # do not write a template for a partial stack
+    if len(failed) > 0:
+        print(f'Failed to clip {len(failed)} of {len(jobs)} files:')
+        for file in sorted(failed):
+            print(f'    {file}')
+        sys.exit(1)
 
     # Generate the template file
     mintpy_path = os.path.join(cwd, parameters.output, 'mintpy')
-    build_template(mintpy_path)
+    build_template(mintpy_path, outputs)
 
 
 if __name__ == '__main__':